@@ -1,3 +1,6 @@
+import itertools
+
+import numpy as np
 import pytest
 import torch
 from nanotron import distributed as dist
@@ -13,20 +16,28 @@ from examples.doremi.doremi.dataloader import (
     DistributedSamplerForDoReMi,
 )
 from examples.doremi.doremi.doremi_context import DoReMiContext
-from tests.helpers.utils import init_distributed
+from tests.helpers.utils import close_worker_pool, init_distributed
+
 
+@pytest.fixture(scope="module", autouse=True)
+def worker_pool():
+    # NOTE: release the GPUs held by the reused workers once this module's tests are done
+    yield
+    close_worker_pool()
 
-@pytest.fixture
+
+# NOTE: the datasets are never mutated by the tests, so we build them once per session
+@pytest.fixture(scope="session")
 def dataset1():
     return create_dummy_dataset(7000)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def dataset2():
     return create_dummy_dataset(3000)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def datasets(dataset1, dataset2):
     return [dataset1, dataset2]
 
@@ -41,7 +52,7 @@ def test_dist_doremi_sampler_sync_across_tp(num_microbatches, dataset1, is_proxy
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
 
-    init_distributed(tp=2, dp=1, pp=1)(_test_dist_doremi_sampler_sync_across_tp)(
+    init_distributed(tp=2, dp=1, pp=1, reuse=True)(_test_dist_doremi_sampler_sync_across_tp)(
         batch_size=BATCH_SIZE,
         num_microbatches=num_microbatches,
         datasets=datasets,
@@ -82,7 +93,9 @@ def test_dist_doremi_sampler_not_overlapse_across_dp_for_proxy_training(dp_size,
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
 
-    init_distributed(tp=1, dp=2, pp=1)(_test_dist_doremi_sampler_not_overlapse_across_dp_for_proxy_training)(
+    init_distributed(tp=1, dp=2, pp=1, reuse=True)(
+        _test_dist_doremi_sampler_not_overlapse_across_dp_for_proxy_training
+    )(
         batch_size=batch_size,
         num_microbatches=num_microbatches,
         datasets=datasets,
@@ -110,17 +123,19 @@ def _test_dist_doremi_sampler_not_overlapse_across_dp_for_proxy_training(
         parallel_context=parallel_context,
     )
 
+    # NOTE: the sampler always yields `batch_size` indices, so the all_gather buffers are allocated once
+    gathered_idxs = [torch.empty(batch_size, dtype=torch.long, device="cuda") for _ in range(dp_size)]
     for idxs in sampler:
         idxs = torch.tensor(idxs, device="cuda").view(-1)
 
         # NOTE: i tried to use assert_fail_except_rank_with, but it mark the test as failed
         # even the test raises an exception as expected
-        gathered_idxs = [torch.empty_like(idxs, device="cuda") for _ in range(dp_size)]
         dist.all_gather(gathered_idxs, idxs)
 
         # NOTE: whether proxy or reference training
-        # the idxs should not be overlapse
-        assert not torch.any(torch.isin(*gathered_idxs))
+        # the idxs should not be overlapse, so there are no equal neighbours once sorted
+        sorted_idxs, _ = torch.cat(gathered_idxs).sort()
+        assert not torch.any(sorted_idxs[1:] == sorted_idxs[:-1])
 
 
 @pytest.mark.parametrize("num_microbatches", [1, 32])
@@ -132,9 +147,10 @@ def test_determistic_doremi_sampler(num_microbatches, dataset1, is_proxy):
     datasets = [dataset1 for _ in range(NUM_DOMAINS)]
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
+    # NOTE: keep three epochs, so that the first one is replayed after more than one reset
     n_epochs = 3
 
-    init_distributed(tp=1, dp=1, pp=1)(_test_determistic_doremi_sampler)(
+    init_distributed(tp=1, dp=1, pp=1, reuse=True)(_test_determistic_doremi_sampler)(
         batch_size=BATCH_SIZE,
         num_microbatches=num_microbatches,
         datasets=datasets,
@@ -166,17 +182,12 @@ def _test_determistic_doremi_sampler(
 
     idxs_per_epoch = []
     for _ in range(n_epochs):
-        all_idxs = []
-        for idxs in sampler:
-            all_idxs.append(idxs)
-
-        idxs_per_epoch.append(all_idxs)
+        all_idxs = list(itertools.chain.from_iterable(sampler))
+        idxs_per_epoch.append(torch.tensor(all_idxs, dtype=torch.long))
         sampler.reset()
 
     # NOTE: check if the sequence of idxs across epochs are all the same
-    assert all(
-        all(arr1[i] == arr2[i] for i in range(len(arr1))) for arr1, arr2 in zip(idxs_per_epoch, idxs_per_epoch[1:])
-    )
+    assert all(torch.equal(idxs_per_epoch[0], idxs) for idxs in idxs_per_epoch[1:])
 
 
 @pytest.mark.parametrize("dp_size", [1, 2, 4])
@@ -197,7 +208,9 @@ def test_sampling_from_dist_doremi_sampler_with_global_batch_size(
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
 
-    init_distributed(tp=1, dp=dp_size, pp=1)(_test_sampling_from_dist_doremi_sampler_with_global_batch_size)(
+    init_distributed(tp=1, dp=dp_size, pp=1, reuse=True)(
+        _test_sampling_from_dist_doremi_sampler_with_global_batch_size
+    )(
         batch_size=batch_size,
         num_microbatches=num_microbatches,
         global_batch_size=GLOBAL_BATCH_SIZE,
@@ -227,44 +240,59 @@ def _test_sampling_from_dist_doremi_sampler_with_global_batch_size(
         parallel_context=parallel_context,
     )
 
-    domain_weights = doremi_context.domain_weights
-    global_batch_size_per_domain = [round(global_batch_size * weight.item()) for weight in domain_weights]
+    # NOTE: the context is only needed to build the sampler, the expected counts are computed from a numpy copy
+    domain_weights = doremi_context.domain_weights.cpu().numpy()
+    global_batch_size_per_domain = np.rint(global_batch_size * domain_weights).astype(np.int64)
+
+    # NOTE: the datasets don't change during the test, so we compute the offsets of each domain once
+    offsets = list(itertools.accumulate([len(ds) for ds in datasets], initial=0))
+    domain_boundaries = torch.tensor(offsets[1:-1])
 
     microbatch_idx = 0
-    num_samples_per_domain = [0 for _ in range(len(domain_weights))]
+    num_samples_per_domain = torch.zeros(len(domain_weights), dtype=torch.int)
+    # NOTE: one row of per-domain counts per global batch, reduced across dp ranks once at the end
+    num_samples_per_domain_per_global_batch = []
     for idxs in sampler:
         assert batch_size == len(idxs)
 
         # NOTE: make sure the indices from a batch
         # is proportion to the domain weights
-        start_indices = [sum([len(ds) for ds in datasets[:i]]) for i in range(len(datasets))]
-        end_indices = [sum([len(ds) for ds in datasets[: i + 1]]) for i in range(len(datasets))]
-        for domain_idx in range(len(domain_weights)):
-            num_samples = sum(1 for idx in idxs if idx >= start_indices[domain_idx] and idx < end_indices[domain_idx])
-            num_samples_per_domain[domain_idx] += num_samples
+        domain_idxs = torch.bucketize(torch.as_tensor(idxs), domain_boundaries, right=True)
+        num_samples_per_domain += torch.bincount(domain_idxs, minlength=len(domain_weights))
 
         if microbatch_idx == num_microbatches - 1:
             # NOTE: if this is the last microbatch => we iterate through all the microbatches
             # now we check if the overall number of samples in each domain is correct across
             # all the microbatches
-            num_samples_per_domain = torch.tensor(num_samples_per_domain, dtype=torch.int, device="cuda")
-
-            # NOTE: the domain weights are chosen so that we expect
-            # no domains have zero sample in the global batch size
-            dist.all_reduce(num_samples_per_domain, op=dist.ReduceOp.SUM)
-            assert (num_samples_per_domain == 0).sum().item() == 0
-
-            for expected_bs, bs in zip(global_batch_size_per_domain, num_samples_per_domain):
-                assert bs > 0
-                # NOTE: take into account rounding errors
-                # across all the dp ranks
-                assert abs(expected_bs - bs) <= dp_size, f"abs(expected_bs - bs): {abs(expected_bs - bs)}"
-
+            num_samples_per_domain_per_global_batch.append(num_samples_per_domain)
             microbatch_idx = 0
-            num_samples_per_domain = [0 for _ in range(len(domain_weights))]
+            num_samples_per_domain = torch.zeros(len(domain_weights), dtype=torch.int)
         else:
             microbatch_idx += 1
 
+    assert len(num_samples_per_domain_per_global_batch) > 0
+    num_samples_per_domain_per_global_batch = torch.stack(num_samples_per_domain_per_global_batch).to("cuda")
+
+    # NOTE: only the first dp rank receives the reduced counts, so it is the one checking them
+    dist.reduce(
+        num_samples_per_domain_per_global_batch,
+        dst=dist.get_global_rank(group=parallel_context.dp_pg, group_rank=0),
+        op=dist.ReduceOp.SUM,
+        group=parallel_context.dp_pg,
+    )
+    if dp_rank == 0:
+        # NOTE: a single device-to-host copy, then all the comparisons are vectorized on the host
+        num_samples_per_domain_per_global_batch = num_samples_per_domain_per_global_batch.cpu().numpy()
+
+        # NOTE: the domain weights are chosen so that we expect
+        # no domains have zero sample in the global batch size
+        assert (num_samples_per_domain_per_global_batch > 0).all()
+
+        # NOTE: take into account rounding errors
+        # across all the dp ranks
+        diffs = np.abs(global_batch_size_per_domain - num_samples_per_domain_per_global_batch)
+        assert (diffs <= dp_size).all(), f"abs(expected_bs - bs): {diffs}"
+
 
 @pytest.mark.parametrize("dp_size", [1, 2, 4])
 @pytest.mark.parametrize("num_microbatches", [1, 32])
@@ -278,7 +306,7 @@ def test_dist_doremi_sampler_not_repeating_samples(dp_size, num_microbatches, da
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
 
-    init_distributed(tp=1, dp=dp_size, pp=1)(_test_dist_doremi_sampler_not_repeating_samples)(
+    init_distributed(tp=1, dp=dp_size, pp=1, reuse=True)(_test_dist_doremi_sampler_not_repeating_samples)(
         batch_size=batch_size,
         num_microbatches=num_microbatches,
         datasets=datasets,
@@ -306,30 +334,36 @@ def _test_dist_doremi_sampler_not_repeating_samples(
         parallel_context=parallel_context,
     )
 
-    local_yieled_idxs = []
-    yielded_idxs = []
-    epoch = 0
+    # NOTE: keep the locally seen indices in a set, so that checking a new batch against them is O(batch_size)
+    local_seen_idxs = set()
+    # NOTE: the indices gathered from all the dp ranks stay on device until the final check.
+    # Indices can't repeat, so at most every sample of every dataset gets yielded
+    num_samples = sum(len(ds) for ds in datasets)
+    yielded_idxs = torch.empty(num_samples, dtype=torch.int, device="cuda")
+    num_yielded_idxs = 0
+    # NOTE: the sampler always yields `batch_size` indices, so the all_gather buffers are allocated once
+    idxs_buffer = torch.empty(batch_size, dtype=torch.int, device="cuda")
+    gathered_idxs = [torch.empty_like(idxs_buffer) for _ in range(dp_size)]
     for idxs in sampler:
         # NOTE: check that the indices are not repeated
-        assert not set(idxs).intersection(
-            local_yieled_idxs
-        ), f"set(idxs): {set(idxs)}, local_yieled_idxs: {local_yieled_idxs}"
-        assert not set(idxs).intersection(
-            yielded_idxs
-        ), f"set(idxs): {set(idxs)}, yielded_idxs: {yielded_idxs} \
-        epoch: {epoch}"
+        assert local_seen_idxs.isdisjoint(
+            idxs
+        ), f"set(idxs): {set(idxs)}, repeated: {local_seen_idxs.intersection(idxs)}"
 
-        local_yieled_idxs.extend(idxs)
+        local_seen_idxs.update(idxs)
 
         # NOTE: gather all the indices from all the dp ranks
-        idxs = torch.tensor(idxs, dtype=torch.int, device="cuda")
-        all_idxs = [torch.zeros_like(idxs) for _ in range(dp_size)]
-        dist.all_gather(all_idxs, idxs)
-        all_idxs = torch.cat(all_idxs, dim=0).view(-1).cpu().tolist()
-        yielded_idxs.extend(all_idxs)
-        epoch += 1
+        idxs_buffer.copy_(torch.as_tensor(idxs, dtype=torch.int), non_blocking=True)
+        dist.all_gather(gathered_idxs, idxs_buffer)
+        num_gathered_idxs = dp_size * batch_size
+        assert (
+            num_yielded_idxs + num_gathered_idxs <= num_samples
+        ), f"Yielded more indices than the {num_samples} samples, so some of them are repeated"
+        torch.cat(gathered_idxs, out=yielded_idxs[num_yielded_idxs : num_yielded_idxs + num_gathered_idxs])
+        num_yielded_idxs += num_gathered_idxs
 
-    assert len(set(yielded_idxs)) == len(yielded_idxs)
+    # NOTE: no index is yielded twice, neither by the same dp rank nor by two different ones
+    assert torch.unique(yielded_idxs[:num_yielded_idxs]).numel() == num_yielded_idxs
 
 
 @pytest.mark.parametrize("dp_size", [2, 4, 8])
@@ -344,7 +378,7 @@ def test_yielding(dp_size, num_microbatches, dataset1, is_proxy):
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
 
-    init_distributed(tp=1, dp=dp_size, pp=1)(_test_yielding)(
+    init_distributed(tp=1, dp=dp_size, pp=1, reuse=True)(_test_yielding)(
         batch_size=BATCH_SIZE,
         global_batch_size=global_batch_size,
         num_microbatches=num_microbatches,
@@ -376,7 +410,7 @@ def _test_yielding(
 
     step = 0
     num_yielded_microbatches = 0
-    expected_domain_weights = torch.tensor([0.5, 0.5])
+    expected_domain_weights = (0.5, 0.5)
 
     for idxs in sampler:
         idxs = torch.tensor(idxs, dtype=torch.int, device="cuda")
@@ -408,7 +442,7 @@ def test_yielding_with_dataloader(dp_size, num_microbatches, dataset1, is_proxy)
     domain_keys = [f"domain {i}" for i in range(NUM_DOMAINS)]
     doremi_context = DoReMiContext(domain_keys, is_proxy=is_proxy)
 
-    init_distributed(tp=1, dp=dp_size, pp=1)(_test_yielding_with_dataloader)(
+    init_distributed(tp=1, dp=dp_size, pp=1, reuse=True)(_test_yielding_with_dataloader)(
         batch_size=BATCH_SIZE,
         global_batch_size=global_batch_size,
         num_microbatches=num_microbatches,
@@ -442,7 +476,7 @@ def _test_yielding_with_dataloader(
 
     step = 1
     num_yielded_microbatches = 0
-    expected_domain_weights = torch.tensor([0.5, 0.5])
+    expected_domain_weights = (0.5, 0.5)
 
     for idxs in dataloader:
         num_idxs = torch.tensor(len(idxs["text"]), dtype=torch.int, device="cuda")
@@ -222,13 +222,13 @@ class ParallelDroplessMLP(torch.nn.Module):
             repeated_tokens_per_expert = repeated_tokens_per_expert.view(self.expert_pg_size, self.experts_per_rank)
             parallel_tokens_per_expert = parallel_tokens_per_expert.view(self.expert_pg_size, self.experts_per_rank)
 
-            send_counts = repeated_tokens_per_expert.cpu().sum(dim=-1)
-            parallel_tokens_per_expert_cpu = parallel_tokens_per_expert.cpu()
-            recv_counts = parallel_tokens_per_expert_cpu.sum(dim=-1)
-
-            # Convert the send/recv counts to lists.
-            send_counts = send_counts.tolist()
-            recv_counts = recv_counts.tolist()
+            # Reduce the send/recv counts on device and convert them to lists
+            # with a single device to host copy.
+            send_counts, recv_counts = (
+                torch.stack([repeated_tokens_per_expert.sum(dim=-1), parallel_tokens_per_expert.sum(dim=-1)])
+                .cpu()
+                .tolist()
+            )
             tokens_received = sum(recv_counts)
 
         x = ops.repeat(x, (self.hidden_sharding_degree, 1))
@@ -14,9 +14,11 @@
 # limitations under the License.
 """PyTorch LLaMa model."""
 
-from typing import Dict, Optional, Union, List
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
+from packaging import version
 from torch import nn
 
 from nanotron import distributed as dist
@@ -26,7 +28,7 @@ from nanotron.config.models_config import RandomInit, SpectralMupInit
 from nanotron.generation.generate_store import AttachableStore
 from nanotron.logging import log_rank
 from nanotron.models import NanotronModel
-from nanotron.nn.activations import ACT2FN
+from nanotron.nn.activations import ACT2FN, SiLUActivation
 from nanotron.nn.layer_norm import TritonRMSNorm
 from nanotron.parallel import ParallelContext
 from nanotron.parallel.parameters import NanotronParameter
@@ -89,9 +91,9 @@ class RotaryEmbedding(nn.Module):
         position_ids: Optional[torch.LongTensor],  # [batch_size, seq_length]
     ):
         batch_size, seq_length, num_heads, inner_dim = x.shape
-        while (
-            position_ids is not None and position_ids[-1, -1] >= self.end
-        ) or seq_length >= self.end:  # TODO @nouamane: check if this causes cpu-gpu sync
+        # Read the last position id once, each comparison against the cuda tensor causes a cpu-gpu sync
+        last_position_id = position_ids[-1, -1].item() if position_ids is not None else None
+        while (last_position_id is not None and last_position_id >= self.end) or seq_length >= self.end:
             self.end *= 2
             self._initialized_buffer = False
         if self._initialized_buffer is False:
@@ -109,7 +111,7 @@ class RotaryEmbedding(nn.Module):
             freqs_cis = self.freqs_cis[None, :seq_length, None, :]
         else:
             # TODO(kunhao): Should None follow the num_heads dimension?
-            if position_ids[-1, -1] < 0 or position_ids[-1, -1] >= self.end:  # Quick test hopefully
+            if last_position_id < 0 or last_position_id >= self.end:  # Quick test hopefully
                 raise ValueError(f"Position ids must be in the range [0, {self.end}), but got {position_ids}")
             freqs_cis = self.freqs_cis[position_ids][:, :, None, :]
         complex_freqs = torch.view_as_complex(freqs_cis)
@@ -121,9 +123,19 @@ class GLUActivation(nn.Module):
     def __init__(self, act_fn_name: str):
         super().__init__()
         self.act = ACT2FN[act_fn_name]
+        # SwiGLU gets a fused kernel computing `silu(gate) * up` in a single pass over the merged states
+        self.is_swiglu = isinstance(self.act, SiLUActivation)
+        if self.is_swiglu:
+            from flash_attn.ops.activations import swiglu
+
+            self.swiglu = swiglu
 
     def forward(self, merged_states: torch.Tensor):
-        gate_states, up_states = torch.split(merged_states, merged_states.shape[-1] // 2, dim=-1)
+        split_size = merged_states.shape[-1] // 2
+        gate_states = merged_states.narrow(-1, 0, split_size)
+        up_states = merged_states.narrow(-1, split_size, split_size)
+        if self.is_swiglu:
+            return self.swiglu(gate_states, up_states)
         return self.act(gate_states) * up_states
 
 
@@ -172,8 +184,46 @@ class MLP(nn.Module):
         return {"hidden_states": hidden_states}
 
 
+class CuSeqlensCache:
+    """Cumulative sequence lengths of the last `sequence_mask` seen.
+
+    One instance is shared by all the decoder layers of a model: every layer of a forward pass receives the very same
+    `sequence_mask` tensor, so the offsets only need to be built once per microbatch.
+    """
+
+    def __init__(self):
+        self._entry: Optional[Tuple[torch.Tensor, int, torch.Tensor]] = None
+
+    def get(self, sequence_mask: torch.Tensor) -> torch.Tensor:
+        # Inference tensors don't track a version counter, so we can't tell whether they were modified in place
+        if sequence_mask.is_inference():
+            return self._compute(sequence_mask)
+
+        # The entry holds a reference to the mask, so identity can't be confused with a freed and reallocated tensor
+        if self._entry is not None and self._entry[0] is sequence_mask and self._entry[1] == sequence_mask._version:
+            return self._entry[2]
+
+        cu_seqlens = self._compute(sequence_mask)
+        self._entry = (sequence_mask, sequence_mask._version, cu_seqlens)
+        return cu_seqlens
+
+    @staticmethod
+    def _compute(sequence_mask: torch.Tensor) -> torch.Tensor:
+        cu_seqlens = torch.zeros((sequence_mask.shape[0] + 1), dtype=torch.int32, device=sequence_mask.device)
+        torch.cumsum(sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens[1:])
+        return cu_seqlens
+
+
 class CoreAttention(nn.Module):
-    def __init__(self, config: LlamaConfig, parallel_config: Optional[ParallelismArgs], layer_idx: int):
+    def __init__(
+        self,
+        config: LlamaConfig,
+        parallel_config: Optional[ParallelismArgs],
+        layer_idx: int,
+        cu_seqlens_cache: Optional[CuSeqlensCache] = None,
+    ):
+        from flash_attn.flash_attn_interface import flash_attn_varlen_func
+
         super().__init__()
         # TODO @thomasw21: GPT has a weird `d_kv` config which I'm guessing is essentically a `d_qkv`
         assert (
@@ -182,6 +232,12 @@ class CoreAttention(nn.Module):
         self.d_qk = config.hidden_size // config.num_attention_heads
         self.d_v = config.hidden_size // config.num_attention_heads
         self.is_using_mup = config.is_using_mup
+        # NOTE: this scale is for µTransfer,
+        # in SP, we use sqrt(1/d_h)
+        self.softmax_scale = 1 / self.d_qk if self.is_using_mup else None
+        # Bind the attention function once instead of resolving the import on every forward
+        self.attention_func = flash_attn_varlen_func
+        self.cu_seqlens_cache = cu_seqlens_cache if cu_seqlens_cache is not None else CuSeqlensCache()
 
         self.checkpoint_attention = False  # Because flash_attn already does checkpointing
 
@@ -194,22 +250,18 @@ class CoreAttention(nn.Module):
         q_sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, q_length] (can be broadcasted to that size)
         kv_sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, kv_length] (can be broadcasted to that size)
     ):
-        from flash_attn.flash_attn_interface import flash_attn_varlen_func
-
-        # TODO @thomasw21: Compute once, instead of computing for each layers.
-        cu_seqlens_q = torch.zeros((q_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
-        cu_seqlens_k = torch.zeros((kv_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
-        torch.cumsum(q_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_q[1:])
-        torch.cumsum(kv_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_k[1:])
+        cu_seqlens_q = self.cu_seqlens_cache.get(q_sequence_mask)
+        if kv_sequence_mask is q_sequence_mask:
+            # Self-attention during training: queries and keys share the same mask, so do the same cu_seqlens
+            cu_seqlens_k = cu_seqlens_q
+        else:
+            cu_seqlens_k = self.cu_seqlens_cache.get(kv_sequence_mask)
 
         # TODO(kunhao): flash attn's causal means that the query can only attend to the keys before it. This is not
         # what we want if we are using kv cache. This is a hack as we always have q_length == 1 when using kv cache.
         causal = False if q_sequence_mask.shape[1] == 1 else True
 
-        # NOTE: this scale is for µTransfer,
-        # in SP, we use sqrt(1/d_h)
-        softmax_scale = 1 / query_states.shape[-1] if self.is_using_mup else None
-        attn_output = flash_attn_varlen_func(
+        attn_output = self.attention_func(
             q=query_states,
             k=key_states,
             v=value_states,
@@ -218,7 +270,7 @@ class CoreAttention(nn.Module):
             max_seqlen_q=q_sequence_mask.shape[1],
             max_seqlen_k=kv_sequence_mask.shape[1],
             dropout_p=0.0,
-            softmax_scale=softmax_scale,
+            softmax_scale=self.softmax_scale,
             causal=causal,
             return_attn_probs=False,
         )
@@ -261,6 +313,7 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
         layer_idx: int,
+        cu_seqlens_cache: Optional[CuSeqlensCache] = None,
     ):
         from flash_attn.layers.rotary import RotaryEmbedding as FlashRotaryEmbedding
 
@@ -293,6 +346,9 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         self.d_v = config.hidden_size // config.num_attention_heads
         self.d_model = config.hidden_size
         self.is_using_mup = config.is_using_mup
+        # Sizes of q and k/v in the local output of `qkv_proj`, used to slice it with `narrow`
+        self.local_q_size = self.n_local_q_heads * self.d_qk
+        self.local_kv_size = self.n_local_kv_heads * self.d_qk
 
         # TODO @thomasw21: refactor so that we store that default in a single place.
         tp_mode = parallel_config.tp_mode if parallel_config is not None else TensorParallelLinearMode.ALL_REDUCE
@@ -332,13 +388,14 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             pg=tp_pg,
             mode=tp_mode,
             bias=False,
-            async_communication=tp_linear_async_communication,
+            async_communication=tp_linear_async_communication and tp_mode is TensorParallelLinearMode.REDUCE_SCATTER,
         )
 
         self.attention = CoreAttention(
             config,
             parallel_config=parallel_config,
             layer_idx=layer_idx,
+            cu_seqlens_cache=cu_seqlens_cache,
         )
 
         self.prefill_kv_len = (
@@ -362,24 +419,16 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         q_length, batch_size, _ = qkv_states.shape
 
         if self.is_gqa:
-            query_states, key_states, value_states = torch.split(
-                qkv_states,
-                [
-                    self.n_local_q_heads * self.d_qk,
-                    self.n_local_kv_heads * self.d_qk,
-                    self.n_local_kv_heads * self.d_qk,
-                ],
-                dim=-1,
+            # Transpose the fused projection once, q/k/v are then views of it
+            qkv_states = qkv_states.transpose(0, 1).contiguous()  # [batch_size, seq_length, ...]
+            query_states = qkv_states.narrow(-1, 0, self.local_q_size).view(
+                batch_size, q_length, self.n_local_q_heads, self.d_qk
             )
-
-            query_states = (
-                query_states.transpose(0, 1).contiguous().view(batch_size, q_length, self.n_local_q_heads, self.d_qk)
+            key_states = qkv_states.narrow(-1, self.local_q_size, self.local_kv_size).view(
+                batch_size, q_length, self.n_local_kv_heads, self.d_qk
             )
-            key_states = (
-                key_states.transpose(0, 1).contiguous().view(batch_size, q_length, self.n_local_kv_heads, self.d_qk)
-            )
-            value_states = (
-                value_states.transpose(0, 1).contiguous().view(batch_size, q_length, self.n_local_kv_heads, self.d_qk)
+            value_states = qkv_states.narrow(-1, self.local_q_size + self.local_kv_size, self.local_kv_size).view(
+                batch_size, q_length, self.n_local_kv_heads, self.d_qk
             )
         else:
             query_states, key_states, value_states = (
@@ -437,10 +486,11 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     query_states,
                     sequence_mask,
                 )
-                (key_unpad, indices_k, cu_seqlens_k, max_seqlen_k) = bert_padding.unpad_input(
-                    key_states, sequence_mask
-                )
-                (value_unpad, _, _, _) = bert_padding.unpad_input(value_states, sequence_mask)
+                # Query, key and value share `sequence_mask`, so we reuse its unpadding metadata instead of
+                # calling `unpad_input` again (each call recomputes the indices and syncs on `max_seqlen`)
+                cu_seqlens_k, max_seqlen_k = cu_seqlens_q, max_seqlen_q
+                key_unpad = bert_padding.index_first_axis(key_states.flatten(0, 1), indices_q)
+                value_unpad = bert_padding.index_first_axis(value_states.flatten(0, 1), indices_q)
 
                 # NOTE: this scale is for µTransfer,
                 # in SP, we use sqrt(1/d_h)
@@ -558,10 +608,8 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             # Apply rotary embeddings to query/key states
             # NOTE: The layout is different from models/llama.py which is [batch_size, num_heads, seq_length, d_qk]
             # Here it is, [batch_size, seq_length, num_heads, d_qk]
-            # [2, batch_size, seq_length, num_heads, d_qk]
-            key_value_states = torch.cat([key_states.unsqueeze(0), value_states.unsqueeze(0)], dim=0)
             # [batch_size, seq_length, 2, num_heads, d_qk]
-            key_value_states = key_value_states.permute(1, 2, 0, 3, 4).contiguous()
+            key_value_states = torch.stack([key_states, value_states], dim=2)
             query_states, key_value_states = self.flash_rotary_embedding(query_states, kv=key_value_states)
             # [batch_size, seq_length, num_heads, d_qk]
             key_states, value_states = torch.split(key_value_states, 1, dim=2)
@@ -606,6 +654,7 @@ class LlamaDecoderLayer(nn.Module):
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
         layer_idx: int,
+        cu_seqlens_cache: Optional[CuSeqlensCache] = None,
     ):
         super().__init__()
         self.input_layernorm = TritonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
@@ -614,6 +663,7 @@ class LlamaDecoderLayer(nn.Module):
             parallel_config=parallel_config,
             tp_pg=tp_pg,
             layer_idx=layer_idx,
+            cu_seqlens_cache=cu_seqlens_cache,
         )
 
         self.post_attention_layernorm = TritonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
@@ -628,11 +678,10 @@ class LlamaDecoderLayer(nn.Module):
         hidden_states = self.input_layernorm(hidden_states)
 
         output = self.attn(hidden_states=hidden_states, sequence_mask=sequence_mask)
-        hidden_states = output["hidden_states"]
-        hidden_states = hidden_states + residual
-
-        residual = hidden_states
-        hidden_states = self.post_attention_layernorm(hidden_states)
+        # Fused residual add + RMSNorm: returns the normalized states and the new residual `attn_output + residual`
+        hidden_states, residual = self.post_attention_layernorm(
+            output["hidden_states"], residual=residual, prenorm=True
+        )
         hidden_states = self.mlp(hidden_states=hidden_states)["hidden_states"]
         hidden_states = hidden_states + residual
 
@@ -705,6 +754,8 @@ class LlamaModel(nn.Module):
             module_output_keys={"input_embeds"},
         )
 
+        # Shared by the decoder layers, which all see the same `sequence_mask` within a forward pass
+        self.cu_seqlens_cache = CuSeqlensCache()
         self.decoder = nn.ModuleList(
             [
                 PipelineBlock(
@@ -715,6 +766,7 @@ class LlamaModel(nn.Module):
                         "parallel_config": parallel_config,
                         "tp_pg": parallel_context.tp_pg,
                         "layer_idx": layer_idx,
+                        "cu_seqlens_cache": self.cu_seqlens_cache,
                     },
                     module_input_keys={"hidden_states", "sequence_mask"},
                     module_output_keys={"hidden_states", "sequence_mask"},
@@ -820,17 +872,23 @@ class LlamaModel(nn.Module):
             batch_size=global_batch_size,
         )
 
-        model_flops_per_s = model_flops / (iteration_time_in_sec * world_size * 1e12)
-        hardware_flops_per_s = hardware_flops / (iteration_time_in_sec * world_size * 1e12)
+        tflops_denominator = iteration_time_in_sec * world_size * 1e12
+        model_flops_per_s = model_flops / tflops_denominator
+        hardware_flops_per_s = hardware_flops / tflops_denominator
         return model_flops_per_s, hardware_flops_per_s
 
 
-@torch.jit.script
-def masked_mean(loss, label_mask, dtype):
-    # type: (Tensor, Tensor, torch.dtype) -> Tensor
+def masked_mean(loss: torch.Tensor, label_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return (loss * label_mask).sum(dtype=dtype) / label_mask.sum()
 
 
+if version.parse(torch.__version__) >= version.parse("2.0"):
+    # Inductor fuses the masked multiply and both reductions, `dynamic=True` avoids recompiling for each sequence length
+    masked_mean = torch.compile(masked_mean, fullgraph=True, dynamic=True)
+else:
+    masked_mean = torch.jit.script(masked_mean)
+
+
 class Loss(nn.Module):
     def __init__(self, tp_pg: dist.ProcessGroup):
         super().__init__()
@@ -923,8 +981,10 @@ class LlamaForTraining(NanotronModel):
 
         model = self
         initialized_parameters = set()
+        # Resolve modules with a single dict lookup instead of walking the module tree with `get_submodule`
+        module_name_to_module = dict(model.named_modules())
         # Handle tensor parallelism
-        module_id_to_prefix = {id(module): f"{module_name}." for module_name, module in model.named_modules()}
+        module_id_to_prefix = {id(module): f"{module_name}." for module_name, module in module_name_to_module.items()}
         # Fix the root_model
         module_id_to_prefix[id(model)] = ""
 
@@ -945,18 +1005,22 @@ class LlamaForTraining(NanotronModel):
                 # Already initialized
                 continue
 
-            module = model.get_submodule(module_name)
+            module = module_name_to_module[module_name]
             parametrizator.parametrize(param_name, module)
 
             assert full_param_name not in initialized_parameters
             initialized_parameters.add(full_param_name)
 
-        assert initialized_parameters == {
+        # Built independently from the loop above, so that skipped parameters are caught
+        expected_parameters = {
             param.get_tied_info().get_full_name_from_module_id_to_prefix(module_id_to_prefix=module_id_to_prefix)
             if param.is_tied
             else name
             for name, param in model.named_parameters()
-        }, f"Somehow the initialized set of parameters don't match:\n - Expected: { {name for name, _ in model.named_parameters()} }\n - Got: {initialized_parameters}"
+        }
+        assert (
+            initialized_parameters == expected_parameters
+        ), f"Somehow the initialized set of parameters don't match:\n - Expected: {expected_parameters}\n - Got: {initialized_parameters}"
 
     def get_embeddings_lm_head_tied_names(self):
         """Get the names of the tied embeddings and lm_head weights"""
@@ -974,6 +1038,7 @@ class LlamaForTraining(NanotronModel):
         return self.model.get_flops_per_sec(iteration_time_in_sec, sequence_length, global_batch_size)
 
 
+@lru_cache(maxsize=None)
 def get_flops(
     num_layers,
     hidden_size,
@@ -1001,27 +1066,26 @@ def get_flops(
     if num_key_value_heads is None:
         num_key_value_heads = num_heads
     hidden_size_per_head = hidden_size // num_heads
+    # Common factor of all decoder matmuls: 2 flops per multiply-add, for every token of every layer
+    decoder_tokens_flops = 2 * num_layers * batch_size * seq_len
     # In the following we mark the reduced dimension with parentheses
     # decoder
     # self attention
     ## qkv projection
     decoder_qkv_proj_flops_fwd = (
-        2 * num_layers * batch_size * seq_len * (hidden_size) * num_heads * hidden_size_per_head
-        + 2 * num_layers * batch_size * seq_len * (hidden_size) * 2 * num_key_value_heads * hidden_size_per_head
+        decoder_tokens_flops * (hidden_size) * (num_heads + 2 * num_key_value_heads) * hidden_size_per_head
     )
     ## qk logits
-    decoder_qk_logits_flops_fwd = 2 * num_layers * batch_size * num_heads * seq_len * (hidden_size_per_head) * seq_len
+    decoder_qk_logits_flops_fwd = decoder_tokens_flops * num_heads * (hidden_size_per_head) * seq_len
     ## v logits
-    decoder_v_logits_flops_fwd = 2 * num_layers * batch_size * num_heads * seq_len * (seq_len) * hidden_size_per_head
+    decoder_v_logits_flops_fwd = decoder_tokens_flops * num_heads * (seq_len) * hidden_size_per_head
     ## attn out
-    decoder_attn_out_flops_fwd = (
-        2 * num_layers * batch_size * num_heads * seq_len * (hidden_size_per_head) * hidden_size
-    )
+    decoder_attn_out_flops_fwd = decoder_tokens_flops * num_heads * (hidden_size_per_head) * hidden_size
     # FF
     ## 1st layer
-    decoder_ffn_1_flops_fwd = 4 * num_layers * batch_size * seq_len * (hidden_size) * ffn_hidden_size
+    decoder_ffn_1_flops_fwd = 2 * decoder_tokens_flops * (hidden_size) * ffn_hidden_size
     ## 2nd layer
-    decoder_ffn_2_flops_fwd = 2 * num_layers * batch_size * seq_len * (ffn_hidden_size) * hidden_size
+    decoder_ffn_2_flops_fwd = decoder_tokens_flops * (ffn_hidden_size) * hidden_size
 
     decoder_flops_fwd = (
         decoder_qkv_proj_flops_fwd
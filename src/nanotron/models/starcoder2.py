@@ -24,6 +24,7 @@ import math
 from typing import Dict, List, Optional, Tuple, Union
 
 import torch
+from packaging import version
 from torch import nn
 from torch.nn import LayerNorm, init
 from torch.nn import functional as F
@@ -1372,12 +1373,17 @@ class GPTModel(nn.Module):
         return fp32_sharded_logits
 
 
-@torch.jit.script
-def masked_mean(loss, label_mask, dtype):
-    # type: (Tensor, Tensor, torch.dtype) -> Tensor
+def masked_mean(loss: torch.Tensor, label_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return (loss * label_mask).sum(dtype=dtype) / label_mask.sum()
 
 
+if version.parse(torch.__version__) >= version.parse("2.0"):
+    # Single fused kernel: both reductions share the same pass over `loss` and `label_mask`
+    masked_mean = torch.compile(masked_mean, fullgraph=True, dynamic=True)
+else:
+    masked_mean = torch.jit.script(masked_mean)
+
+
 class Loss(nn.Module):
     def __init__(self, tp_pg: dist.ProcessGroup):
         super().__init__()
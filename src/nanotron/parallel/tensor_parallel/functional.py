@@ -51,8 +51,9 @@ class _ShardedCrossEntropy(torch.autograd.Function):
 
         # Create a mask of valid ids (1 means it needs to be masked).
         target_mask = (target < start_index) | (target >= end_index)
-        masked_target = target.clone() - start_index
-        masked_target[target_mask] = 0
+        # NOTE: the subtraction already allocates a new tensor, no need to clone `target`
+        masked_target = target - start_index
+        masked_target.masked_fill_(target_mask, 0)
 
         # Get predicted-logits = logits[target].
         # For Simplicity, we convert logits to a 2-D tensor with size
@@ -60,13 +61,10 @@ class _ShardedCrossEntropy(torch.autograd.Function):
         logits_2d = sharded_logits.view(-1, sharded_hidden_size)
         masked_target_1d = masked_target.view(-1)
         arange_1d = torch.arange(start=0, end=logits_2d.shape[0], device=logits_2d.device)
+        # NOTE: advanced indexing returns a new contiguous tensor, so we can write into it without cloning
         predicted_logits_1d = logits_2d[arange_1d, masked_target_1d]
-        if predicted_logits_1d.is_contiguous():
-            predicted_logits_1d = predicted_logits_1d.clone()
-        else:
-            predicted_logits_1d = predicted_logits_1d.contiguous()
         predicted_logits = predicted_logits_1d.view_as(target)
-        predicted_logits[target_mask] = 0.0
+        predicted_logits.masked_fill_(target_mask, 0.0)
         # All reduce is needed to get the chunks from other GPUs.
         dist.all_reduce(predicted_logits, op=dist.ReduceOp.SUM, group=group)
 
@@ -1,7 +1,9 @@
+from collections import defaultdict
 from contextlib import contextmanager
-from typing import Callable, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import torch
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from nanotron import distributed as dist
 from nanotron import logging, optim
@@ -14,6 +16,33 @@ from nanotron.parallel.tied_parameters import get_tied_id_to_param
 
 logger = get_logger(__name__)
 
+# Receive buffers of non reference ranks, reused across sanity checks to avoid churning the caching allocator.
+# They grow on demand up to `_MAX_SCRATCH_BUFFER_SIZE`. Bigger tensors get a fresh allocation, so that we don't hold on
+# to e.g. a full embedding for the whole training.
+_MAX_SCRATCH_BUFFER_SIZE = 32 * 1024 * 1024
+_scratch_buffers: Dict[Tuple[torch.dtype, torch.device], torch.Tensor] = {}
+
+
+def _get_scratch_buffer(numel: int, like: torch.Tensor) -> torch.Tensor:
+    """Returns an uninitialized 1D buffer of `numel` elements with the dtype and device of `like`"""
+    if numel * like.element_size() > _MAX_SCRATCH_BUFFER_SIZE:
+        return torch.empty(numel, dtype=like.dtype, device=like.device)
+
+    key = (like.dtype, like.device)
+    buffer = _scratch_buffers.get(key)
+    if buffer is None or buffer.numel() < numel:
+        # Drop the old buffer first, so that the caching allocator can reuse its memory
+        _scratch_buffers.pop(key, None)
+        del buffer
+        buffer = torch.empty(numel, dtype=like.dtype, device=like.device)
+        _scratch_buffers[key] = buffer
+    return buffer[:numel]
+
+
+def clear_scratch_buffers() -> None:
+    """Release the receive buffers of the sanity checks, e.g. before calling `torch.cuda.empty_cache()`"""
+    _scratch_buffers.clear()
+
 
 def assert_tensor_synced_across_pg(
     tensor: torch.Tensor,
@@ -22,20 +51,125 @@ def assert_tensor_synced_across_pg(
     reference_rank: int = 0,
 ):
     """Assert that `tensor` is synced across `pg` with reference rank. Note that this always passes for reference rank"""
-    if dist.get_rank(pg) == reference_rank:
+    is_reference_rank = dist.get_rank(pg) == reference_rank
+    if is_reference_rank:
         reference_tensor = tensor
     else:
-        reference_tensor = torch.empty_like(tensor)
+        reference_tensor = _get_scratch_buffer(tensor.numel(), like=tensor).view(tensor.shape)
     dist.broadcast(
         reference_tensor,
         src=dist.get_global_rank(group=pg, group_rank=reference_rank),
         group=pg,
     )
 
+    if is_reference_rank:
+        return
+
     # TODO @nouamane: Getting Greatest absolute difference: 4.6e-10 at large scale when syncing tied weights
     torch.testing.assert_close(tensor, reference_tensor, msg=msg)
 
 
+@torch.no_grad()
+def assert_tensors_synced_across_pg(
+    named_tensors: Iterable[Tuple[str, torch.Tensor]],
+    pg: dist.ProcessGroup,
+    msg: Optional[Callable[[str, str], str]] = None,
+    reference_rank: int = 0,
+    bucket_size_mb: int = 32,
+):
+    """Bucketed version of `assert_tensor_synced_across_pg`.
+
+    Tensors sharing the same dtype and device are flattened into buckets of at most `bucket_size_mb`, so we run one
+    broadcast per bucket instead of one per tensor. `msg` receives the name of the tensor and the error message.
+    """
+    is_reference_rank = dist.get_rank(pg) == reference_rank
+    src = dist.get_global_rank(group=pg, group_rank=reference_rank)
+    bucket_size = bucket_size_mb * 1024 * 1024
+
+    def check_bucket(bucket: List[Tuple[str, torch.Tensor]]):
+        if len(bucket) == 1:
+            # Typically a tensor bigger than the bucket (e.g. embeddings): broadcast it in place instead of copying it
+            name, tensor = bucket[0]
+            assert_tensor_synced_across_pg(
+                tensor, pg=pg, msg=None if msg is None else lambda err: msg(name, err), reference_rank=reference_rank
+            )
+            return
+
+        names, tensors = zip(*bucket)
+        if is_reference_rank:
+            flat_reference = _flatten_dense_tensors(tensors)
+        else:
+            flat_reference = _get_scratch_buffer(sum(tensor.numel() for tensor in tensors), like=tensors[0])
+        dist.broadcast(flat_reference, src=src, group=pg)
+
+        # The reference rank always passes
+        if is_reference_rank:
+            return
+
+        for name, tensor, reference_tensor in zip(names, tensors, _unflatten_dense_tensors(flat_reference, tensors)):
+            torch.testing.assert_close(
+                tensor, reference_tensor, msg=None if msg is None else lambda err: msg(name, err)
+            )
+
+    # (dtype, device) -> (bucket, bucket size in bytes)
+    buckets = {}
+    for name, tensor in named_tensors:
+        key = (tensor.dtype, tensor.device)
+        tensor_size = tensor.numel() * tensor.element_size()
+        bucket, size = buckets.get(key, ([], 0))
+        # Flush before going over the limit, so that buckets fit in the scratch buffers
+        if len(bucket) > 0 and size + tensor_size > bucket_size:
+            check_bucket(bucket)
+            bucket, size = [], 0
+        bucket.append((name, tensor))
+        buckets[key] = (bucket, size + tensor_size)
+
+    for bucket, _ in buckets.values():
+        if len(bucket) > 0:
+            check_bucket(bucket)
+
+
+def _group_tied_params_by_ranks(
+    tied_params_list: Iterable[Tuple[Tuple[str, Tuple[int, ...]], torch.Tensor]]
+) -> Dict[Tuple[int, ...], List[Tuple[str, torch.Tensor]]]:
+    """Group `((name, group_ranks), tensor)` items per `group_ranks`, so that each group can be checked in one go"""
+    tensors_per_group_ranks = defaultdict(list)
+    for (name, group_ranks), tensor in tied_params_list:
+        tensors_per_group_ranks[group_ranks].append((name, tensor))
+    return tensors_per_group_ranks
+
+
+def _get_sanity_checks_cache(unwrapped_model: NanotronModel, parallel_context: ParallelContext) -> Dict:
+    """Parameter ordering and tied groups don't change during training, so we compute them once and cache them.
+    The cache is rebuilt if the number of parameters changes (e.g. parameters were added after the first check).
+    """
+    num_params = sum(1 for _ in unwrapped_model.parameters())
+    cache = getattr(unwrapped_model, "_sanity_checks_cache", None)
+    if cache is None or cache["num_params"] != num_params:
+        tied_params_list = sorted(
+            get_tied_id_to_param(
+                parameters=unwrapped_model.parameters(),
+                root_module=unwrapped_model,
+            ).items(),
+            key=lambda x: x[0],
+        )
+        group_ranks_to_pg = {
+            group_ranks: parallel_context.world_ranks_to_pg[group_ranks] for (_, group_ranks), _ in tied_params_list
+        }
+        cache = {
+            "num_params": num_params,
+            "sorted_named_params": sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]),
+            "tied_params_list": tied_params_list,
+            "group_ranks_to_pg": group_ranks_to_pg,
+            "tied_params_per_pg": [
+                (group_ranks_to_pg[group_ranks], named_params)
+                for group_ranks, named_params in _group_tied_params_by_ranks(tied_params_list).items()
+            ],
+        }
+        unwrapped_model._sanity_checks_cache = cache
+    return cache
+
+
 # TODO @nouamanetazi: remove this with SANITY_CHECKS
 @contextmanager
 def assert_fail_except_rank_with(exception_class, rank_exception, pg):
@@ -53,6 +187,11 @@ def assert_fail_except_rank_with(exception_class, rank_exception, pg):
         raise AssertionError(f"Expected {exception_class} to be raised, but no exception was raised.")
 
 
+def noop_sanity_checks(*args, **kwargs) -> None:
+    """Bound in place of the sanity checks below when `config.general.ignore_sanity_checks` is set"""
+    return None
+
+
 def before_tbi_sanity_checks(
     config: Config,
     parallel_context: ParallelContext,
@@ -60,41 +199,28 @@ def before_tbi_sanity_checks(
     grad_accumulator: GradientAccumulator,
 ) -> None:
     if not config.general.ignore_sanity_checks:
+        cache = _get_sanity_checks_cache(unwrapped_model, parallel_context)
+
         # SANITY CHECK: Check that the model params are synchronized across dp
-        for name, param in sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]):
-            assert_tensor_synced_across_pg(
-                tensor=param,
-                pg=parallel_context.dp_pg,
-                msg=lambda err: f"{name} are not synchronized across DP {err}",
-            )
+        assert_tensors_synced_across_pg(
+            named_tensors=cache["sorted_named_params"],
+            pg=parallel_context.dp_pg,
+            msg=lambda name, err: f"{name} are not synchronized across DP {err}",
+        )
 
         # SANITY CHECK: Tied weights are synchronized
-        tied_params_list = sorted(
-            get_tied_id_to_param(
-                parameters=unwrapped_model.parameters(),
-                root_module=unwrapped_model,
-            ).items(),
-            key=lambda x: x[0],
-        )
-        for (name, group_ranks), param in tied_params_list:
-            group = parallel_context.world_ranks_to_pg[group_ranks]
-            assert_tensor_synced_across_pg(
-                tensor=param,
+        for group, named_params in cache["tied_params_per_pg"]:
+            assert_tensors_synced_across_pg(
+                named_tensors=named_params,
                 pg=group,
-                msg=lambda err: f"[Before train] Tied weights {name} are not synchronized. {err}",
+                msg=lambda name, err: f"[Before train] Tied weights {name} are not synchronized. {err}",
             )
 
         # SANITY CHECK: Check that the grad accumulator buffers are ready for DDP
-        if grad_accumulator is not None:
-            for _, elt in grad_accumulator.fp32_grad_buffers.items():
-                fp32_grad_buffer = elt["fp32_grad"]
-                torch.testing.assert_close(
-                    fp32_grad_buffer,
-                    torch.zeros_like(fp32_grad_buffer),
-                    atol=0,
-                    rtol=0,
-                    msg="Grad accumulator buffers must be zeroed in first accumulation step.",
-                )
+        if grad_accumulator is not None and len(grad_accumulator.fp32_grad_buffers) > 0:
+            fp32_grad_buffers = [elt["fp32_grad"] for elt in grad_accumulator.fp32_grad_buffers.values()]
+            max_abs_grad = torch.stack(torch._foreach_norm(fp32_grad_buffers, ord=float("inf"))).max().item()
+            assert max_abs_grad == 0.0, "Grad accumulator buffers must be zeroed in first accumulation step."
 
         # SANITY CHECK: run model specific sanity checks
         unwrapped_model.before_tbi_sanity_checks()
@@ -110,7 +236,8 @@ def after_tbi_sanity_checks(
         # SANITY CHECK: Check that gradient flow on the entire model
         # SANITY CHECK: Check that all parameters that required gradients, have actually a gradient
         # SANITY CHECK: Check for nan/inf
-        for name, param in unwrapped_model.named_parameters():
+        names, grads = [], []
+        for name, param in _get_sanity_checks_cache(unwrapped_model, parallel_context)["sorted_named_params"]:
             if not param.requires_grad:
                 continue
 
@@ -125,14 +252,24 @@ def after_tbi_sanity_checks(
             else:
                 grad = param.grad
 
-            if torch.isnan(grad).any() or torch.isinf(grad).any():
-                raise ValueError("Gradient is nan or inf")
             if grad is None:
                 log_rank(
                     f"Process rank { dist.get_rank(parallel_context.world_pg)}/{parallel_context.world_pg.size()}: {name} is missing gradient",
                     logger=logger,
                     level=logging.ERROR,
                 )
+                continue
+
+            names.append(name)
+            grads.append(grad)
+
+        if len(grads) > 0:
+            # nan/inf propagate to the infinity norm, so we only need one reduction per gradient and a single host sync
+            grad_norms = torch.stack(torch._foreach_norm(grads, ord=float("inf")))
+            is_finite = torch.isfinite(grad_norms)
+            if not is_finite.all():
+                first_index = (~is_finite).nonzero()[0].item()
+                raise ValueError(f"Gradient is nan or inf for {names[first_index]}")
 
         # SANITY CHECK: run model specific sanity checks
         unwrapped_model.after_tbi_sanity_checks()
@@ -145,29 +282,12 @@ def before_optim_step_sanity_checks(
     grad_accumulator: GradientAccumulator,
 ) -> None:
     if not config.general.ignore_sanity_checks:
-        # SANITY CHECK: Test tied weights gradients are synchronized
-        for (name, group_ranks), param in sorted(
-            get_tied_id_to_param(parameters=unwrapped_model.parameters(), root_module=unwrapped_model).items(),
-            key=lambda x: x[0],
-        ):
-            if not param.requires_grad:
-                continue
-
-            if grad_accumulator is not None:
-                grad = grad_accumulator.get_grad_buffer(name=name)
-            else:
-                grad = param.grad
-
-            assert grad is not None, f"Grad is None for {name}"
-            group = parallel_context.world_ranks_to_pg[group_ranks]
-            assert_tensor_synced_across_pg(
-                tensor=grad,
-                pg=group,
-                msg=lambda err: f"[Before optimizer step] Tied weights grads for {name} are not synchronized. {err}",
-            )
+        cache = _get_sanity_checks_cache(unwrapped_model, parallel_context)
 
-        # SANITY CHECK: Test gradients are synchronized across DP
-        for name, param in sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]):
+        # Single pass over the parameters to gather the gradients used by the checks below
+        named_grads = []
+        tied_id_to_grad = {}
+        for name, param in cache["sorted_named_params"]:
             if not param.requires_grad:
                 continue
 
@@ -183,32 +303,42 @@ def before_optim_step_sanity_checks(
                 grad = param.grad
 
             assert grad is not None, f"Grad is None for {name}"
-            assert_tensor_synced_across_pg(
-                tensor=grad,
-                pg=parallel_context.dp_pg,
-                msg=lambda err: f"[Before optimizer step] weights grads for {name} are not synchronized across DP. {err}",
-            )
+            named_grads.append((name, grad))
+            if param.is_tied:
+                tied_id_to_grad[(name, tied_info.global_ranks)] = grad
 
-        # SANITY CHECK: Check that the model params are synchronized across dp
-        for name, param in sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]):
-            assert_tensor_synced_across_pg(
-                tensor=param,
-                pg=parallel_context.dp_pg,
-                msg=lambda err: f"{name} are not synchronized across DP {err}",
+        # SANITY CHECK: Test tied weights gradients are synchronized
+        # NOTE: we follow the order of `tied_params_list` so that all ranks of a group run their broadcasts in the same order
+        tied_grads_list = [
+            (tied_id, tied_id_to_grad[tied_id]) for tied_id, param in cache["tied_params_list"] if param.requires_grad
+        ]
+        for group_ranks, named_tied_grads in _group_tied_params_by_ranks(tied_grads_list).items():
+            assert_tensors_synced_across_pg(
+                named_tensors=named_tied_grads,
+                pg=cache["group_ranks_to_pg"][group_ranks],
+                msg=lambda name, err: f"[Before optimizer step] Tied weights grads for {name} are not synchronized. {err}",
             )
 
-        # SANITY CHECK: Tied weights are synchronized
-        tied_params_list = sorted(
-            get_tied_id_to_param(parameters=unwrapped_model.parameters(), root_module=unwrapped_model).items(),
-            key=lambda x: x[0],
+        # SANITY CHECK: Test gradients are synchronized across DP
+        assert_tensors_synced_across_pg(
+            named_tensors=named_grads,
+            pg=parallel_context.dp_pg,
+            msg=lambda name, err: f"[Before optimizer step] weights grads for {name} are not synchronized across DP. {err}",
         )
 
-        for (name, group_ranks), param in tied_params_list:
-            group = parallel_context.world_ranks_to_pg[group_ranks]
-            assert_tensor_synced_across_pg(
-                tensor=param,
+        # SANITY CHECK: Check that the model params are synchronized across dp
+        assert_tensors_synced_across_pg(
+            named_tensors=cache["sorted_named_params"],
+            pg=parallel_context.dp_pg,
+            msg=lambda name, err: f"{name} are not synchronized across DP {err}",
+        )
+
+        # SANITY CHECK: Tied weights are synchronized
+        for group, named_params in cache["tied_params_per_pg"]:
+            assert_tensors_synced_across_pg(
+                named_tensors=named_params,
                 pg=group,
-                msg=lambda err: f"[Before optimizer step] Tied weights {name} are not synchronized. {err}",
+                msg=lambda name, err: f"[Before optimizer step] Tied weights {name} are not synchronized. {err}",
             )
 
         # SANITY CHECK: run model specific sanity checks
@@ -239,11 +369,14 @@ def after_optim_step_sanity_checks(
 
 
 def check_optim_state_in_sync(optimizer: optim.BaseOptimizer, pg: dist.ProcessGroup):
-    for _, optim_state in sorted(optimizer.state_dict()["state"].items(), key=lambda x: x[0]):
+    named_states = []
+    for param_id, optim_state in sorted(optimizer.state_dict()["state"].items(), key=lambda x: x[0]):
         for name, tensor in optim_state.items():
             if name == "step":
                 tensor = tensor.to("cuda")
 
-            assert_tensor_synced_across_pg(
-                tensor=tensor, pg=pg, msg=lambda err: f"{name} are not synced across DP {err}"
-            )
+            named_states.append((f"{name} of param {param_id}", tensor))
+
+    assert_tensors_synced_across_pg(
+        named_tensors=named_states, pg=pg, msg=lambda name, err: f"{name} are not synced across DP {err}"
+    )
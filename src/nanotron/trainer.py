@@ -81,6 +81,8 @@ from nanotron.sanity_checks import (
     after_tbi_sanity_checks,
     before_optim_step_sanity_checks,
     before_tbi_sanity_checks,
+    clear_scratch_buffers,
+    noop_sanity_checks,
 )
 from nanotron.scaling.parametrization import ParametrizationMethod
 from nanotron.serialize import (
@@ -252,6 +254,18 @@ class DistributedTrainer:
         # NOTE: the dataloader currently in use for the current training stage
         self.current_dataloader: Optional[DataLoader] = None
 
+        # Bind the sanity checks once, so that they are a no-op in the training loop when they are disabled
+        if self.config.general.ignore_sanity_checks:
+            self.before_tbi_sanity_checks = noop_sanity_checks
+            self.after_tbi_sanity_checks = noop_sanity_checks
+            self.before_optim_step_sanity_checks = noop_sanity_checks
+            self.after_optim_step_sanity_checks = noop_sanity_checks
+        else:
+            self.before_tbi_sanity_checks = before_tbi_sanity_checks
+            self.after_tbi_sanity_checks = after_tbi_sanity_checks
+            self.before_optim_step_sanity_checks = before_optim_step_sanity_checks
+            self.after_optim_step_sanity_checks = after_optim_step_sanity_checks
+
         self.post_init()
 
     def pre_init(self):
@@ -414,6 +428,7 @@ class DistributedTrainer:
         self.unwrapped_model.module_id_to_prefix[id(self.unwrapped_model)] = ""
 
         prof = get_profiler(config=self.config)
+        clear_scratch_buffers()
         torch.cuda.empty_cache()
         with prof:
             for self.iteration_step in range(self.metadata.last_train_step + 1, self.config.tokens.train_steps + 1):
@@ -448,7 +463,7 @@ class DistributedTrainer:
     def training_step(
         self, dataloader: Iterator[Dict[str, Union[torch.Tensor, TensorPointer]]]
     ) -> Tuple[Iterable[Dict], Optional[torch.Tensor]]:
-        before_tbi_sanity_checks(self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator)
+        self.before_tbi_sanity_checks(self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator)
 
         if self.iteration_step < 5:
             log_memory(logger=logger)
@@ -464,7 +479,7 @@ class DistributedTrainer:
         if self.iteration_step < 5:
             log_memory(logger=logger)
 
-        after_tbi_sanity_checks(self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator)
+        self.after_tbi_sanity_checks(self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator)
 
         if isinstance(self.model, DistributedDataParallel) and self.grad_accumulator is not None:
             # Wait for fp32 grads allreduce to finish to make sure grads are synced across DP
@@ -507,7 +522,7 @@ class DistributedTrainer:
                 max_norm=self.config.optimizer.clip_grad,
             )
 
-        before_optim_step_sanity_checks(
+        self.before_optim_step_sanity_checks(
             self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator
         )
 
@@ -530,7 +545,9 @@ class DistributedTrainer:
         # Update the learning rate
         self.lr_scheduler.step()
 
-        after_optim_step_sanity_checks(self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator)
+        self.after_optim_step_sanity_checks(
+            self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator
+        )
 
         if handle is not None:
             handle.wait()
@@ -92,7 +92,9 @@ def checkpoint_method(attr_name: str):
                         all_args.append(kwargs[arg_name])
                 assert len(all_args) == len(signature_params), f"Missing arguments for {func.__name__}"
                 # TODO @nouamanetazi: we pass `self`(which is module) to checkpoint, so it's stored in `ctx.inputs` whereas some other methods create a custom fwd and pass only tensors without `self`. Need to investigate which is better
-                return checkpoint(func, *all_args)
+                # Non-reentrant checkpointing keeps the autograd graph during forward (dropping the saved activations
+                # instead of running in no_grad mode), which avoids the extra graph walk of the reentrant variant
+                return checkpoint(func, *all_args, use_reentrant=False)
             else:
                 return func(*args, **kwargs)
 
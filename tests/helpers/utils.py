@@ -1,6 +1,8 @@
 import contextlib
 import os
+import queue
 import re
+import traceback
 from inspect import signature
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
@@ -243,25 +245,139 @@ def rerun_on_exception(exception_type: Exception = Exception, pattern: str = Non
     return _wrapper
 
 
-def global_wrapper(rank, func, tp, pp, dp, port, kwargs):
-    def setup_dist_env(rank, world_size, port):
-        os.environ["WORLD_SIZE"] = str(world_size)
-        os.environ["RANK"] = str(rank)
-        # NOTE: since we do unit tests in a
-        # single node => this is fine!
-        os.environ["LOCAL_RANK"] = str(rank)
-        os.environ["MASTER_ADDR"] = "localhost"
-        os.environ["MASTER_PORT"] = str(port)
+def setup_dist_env(rank, world_size, port):
+    os.environ["WORLD_SIZE"] = str(world_size)
+    os.environ["RANK"] = str(rank)
+    # NOTE: since we do unit tests in a
+    # single node => this is fine!
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+
 
+def global_wrapper(rank, func, tp, pp, dp, port, kwargs):
     world_size = tp * pp * dp
     setup_dist_env(rank, world_size, port)
     parallel_context = ParallelContext(data_parallel_size=dp, pipeline_parallel_size=pp, tensor_parallel_size=tp)
     func(parallel_context, **kwargs)
 
 
-def init_distributed(tp: int, dp: int, pp: int):
+def pool_worker(rank, tp, pp, dp, port, task_queues, result_queue):
+    """Long-lived worker of `DistributedWorkerPool`: runs the functions it receives until it gets `None`"""
+    world_size = tp * pp * dp
+    setup_dist_env(rank, world_size, port)
+    parallel_context = ParallelContext(data_parallel_size=dp, pipeline_parallel_size=pp, tensor_parallel_size=tp)
+
+    while True:
+        task = task_queues[rank].get()
+        if task is None:
+            break
+
+        func, kwargs = task
+        try:
+            func(parallel_context, **kwargs)
+        except BaseException:
+            result_queue.put((rank, traceback.format_exc()))
+        else:
+            result_queue.put((rank, None))
+
+    parallel_context.destroy()
+
+
+class DistributedWorkerPool:
+    """Spawns `tp * dp * pp` processes with their process groups once, and runs several test functions on them.
+    Creating processes and initializing NCCL dominates the runtime of small distributed tests."""
+
+    def __init__(self, tp: int, dp: int, pp: int):
+        from nanotron.utils import find_free_port
+
+        self.world_size = tp * pp * dp
+        ctx = mp.get_context("spawn")
+        self.task_queues = [ctx.SimpleQueue() for _ in range(self.world_size)]
+        self.result_queue = ctx.Queue()
+        self.process_context = mp.spawn(
+            pool_worker,
+            args=(tp, pp, dp, find_free_port(), self.task_queues, self.result_queue),
+            nprocs=self.world_size,
+            join=False,
+        )
+        self.is_terminated = False
+
+    def run(self, func: Callable, kwargs: Dict[str, Any]):
+        for task_queue in self.task_queues:
+            task_queue.put((func, kwargs))
+
+        num_finished = 0
+        while num_finished < self.world_size:
+            try:
+                rank, error = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                # NOTE: a worker that crashed (eg. segfault) never reports back
+                if not all(process.is_alive() for process in self.process_context.processes):
+                    self.terminate()
+                    raise RuntimeError("A worker of the distributed pool died unexpectedly")
+                continue
+
+            if error is not None:
+                # NOTE: the other ranks might be stuck in a collective waiting for the failed rank
+                self.terminate()
+                raise RuntimeError(f"Process {rank} failed with the following error:\n{error}")
+            num_finished += 1
+
+    def close(self):
+        if self.is_terminated:
+            return
+
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        # NOTE: `join` returns as soon as one process exits, loop until all of them are reaped (like `mp.spawn`)
+        while not self.process_context.join():
+            pass
+
+    def terminate(self):
+        self.is_terminated = True
+        for process in self.process_context.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+# NOTE: we only keep one pool alive at a time, so that we never have more processes than GPUs
+_worker_pool: Optional[Tuple[Tuple[int, int, int], DistributedWorkerPool]] = None
+
+
+def get_worker_pool(tp: int, dp: int, pp: int) -> DistributedWorkerPool:
+    global _worker_pool
+    if _worker_pool is not None and (_worker_pool[0] != (tp, dp, pp) or _worker_pool[1].is_terminated):
+        close_worker_pool()
+    if _worker_pool is None:
+        _worker_pool = ((tp, dp, pp), DistributedWorkerPool(tp=tp, dp=dp, pp=pp))
+    return _worker_pool[1]
+
+
+def close_worker_pool():
+    global _worker_pool
+    if _worker_pool is not None:
+        _, pool = _worker_pool
+        _worker_pool = None
+        pool.close()
+
+
+def init_distributed(tp: int, dp: int, pp: int, reuse: bool = False):
+    """Run the decorated function on `tp * dp * pp` processes.
+
+    If `reuse` is True, the processes and their process groups are kept alive and reused by the next call with the
+    same topology. Only use it for functions that don't leave global state behind (eg. random seeds, env variables).
+    The pool holds the GPUs until `close_worker_pool` is called, so callers must call it when tearing down their
+    tests (eg. in a module-scoped fixture).
+    """
+
     def _init_distributed(func):
         def wrapper(**kwargs):
+            if reuse:
+                get_worker_pool(tp=tp, dp=dp, pp=pp).run(func, kwargs)
+                return
+
             from nanotron.utils import find_free_port
 
             world_size = tp * pp * dp
@@ -17,15 +17,16 @@ class CheckpointedModel(nn.Module):
 
     @checkpoint_method("is_checkpointed")
     def forward(self, x: Union[torch.Tensor, TensorPointer]):
+        # NOTE: count before any op, non-reentrant checkpointing stops recomputing once the last saved tensor
+        # (here the dropout mask) is rebuilt, so anything after it doesn't run again during backward
+        self.fwd_counter += 1
         x = self.dense1(x)
-        if self.is_checkpointed and self.fwd_counter == 0:
-            assert not x.requires_grad, "x should not require grad when checkpointed, because fwd runs in no_grad mode"
-            assert (
-                x.grad_fn is None
-            ), "x should not store any activation when checkpointed, because fwd runs in no_grad mode"
+        if self.is_checkpointed and self.fwd_counter == 1:
+            # Non-reentrant checkpointing runs fwd with grad enabled and only discards the saved activations
+            assert x.requires_grad, "x should require grad when checkpointed, because fwd keeps the autograd graph"
+            assert x.grad_fn is not None, "x should be part of the autograd graph when checkpointed"
         x = self.dense2(x)
         x = self.dropout(x)
-        self.fwd_counter += 1
         return x
 
 
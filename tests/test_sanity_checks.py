@@ -0,0 +1,72 @@
+from typing import List, Optional
+
+import pytest
+import torch
+from helpers.exception import assert_fail_except_rank_with
+from helpers.utils import available_gpus, init_distributed, rerun_if_address_is_in_use
+from nanotron import distributed as dist
+from nanotron.parallel import ParallelContext
+from nanotron.sanity_checks import assert_tensors_synced_across_pg
+
+BUCKET_SIZE_MB = 1
+
+# name -> (dtype, shape). `small_*` share a flattened bucket, `half` gets its own dtype bucket, and `large` doesn't fit
+# in a bucket so it's broadcast in place
+TENSOR_SPECS = {
+    "small_0": (torch.float, (32, 32)),
+    "small_1": (torch.float, (4096,)),
+    "half": (torch.half, (512,)),
+    "large": (torch.float, (2 * BUCKET_SIZE_MB * 1024 * 1024 // 4,)),
+}
+
+
+@pytest.mark.skipif(available_gpus() < 2, reason="test_assert_tensors_synced_across_pg requires at least 2 gpus")
+@pytest.mark.parametrize(
+    "names,desynced_name",
+    [
+        (["small_0", "small_1", "half", "large"], None),
+        # NOTE: the desynced tensor is in the only bucket, so that every rank runs the same collectives before failing
+        (["small_0", "small_1"], "small_1"),
+        (["large"], "large"),
+    ],
+)
+@rerun_if_address_is_in_use()
+def test_assert_tensors_synced_across_pg(names: List[str], desynced_name: Optional[str]):
+    init_distributed(tp=1, dp=2, pp=1)(_test_assert_tensors_synced_across_pg)(names=names, desynced_name=desynced_name)
+
+
+def _test_assert_tensors_synced_across_pg(
+    parallel_context: ParallelContext, names: List[str], desynced_name: Optional[str]
+):
+    device = torch.device("cuda")
+    named_tensors = []
+    for name in names:
+        dtype, shape = TENSOR_SPECS[name]
+        numel = torch.Size(shape).numel()
+        named_tensors.append((name, torch.arange(numel, dtype=dtype, device=device).view(shape)))
+
+    if desynced_name is None:
+        assert_tensors_synced_across_pg(named_tensors, parallel_context.dp_pg, bucket_size_mb=BUCKET_SIZE_MB)
+        parallel_context.destroy()
+        return
+
+    # Only rank 1 drifts away from the reference rank
+    if dist.get_rank(parallel_context.dp_pg) == 1:
+        dict(named_tensors)[desynced_name].view(-1)[-1] += 1
+
+    with assert_fail_except_rank_with(AssertionError, rank_exception=0, pg=parallel_context.dp_pg):
+        assert_tensors_synced_across_pg(
+            named_tensors,
+            parallel_context.dp_pg,
+            msg=lambda name, err: f"{name} is not synced across DP: {err}",
+            bucket_size_mb=BUCKET_SIZE_MB,
+        )
+
+    # Broadcasting in place must leave the reference rank's tensors untouched
+    if dist.get_rank(parallel_context.dp_pg) == 0:
+        for _, tensor in named_tensors:
+            torch.testing.assert_close(
+                tensor.view(-1), torch.arange(tensor.numel(), dtype=tensor.dtype, device=device)
+            )
+
+    parallel_context.destroy()